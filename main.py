@@ -1,8 +1,13 @@
 import os
+import re
 import datetime
-import pytz
-import markdown
-import google.generativeai as genai
+import functools
+import hashlib
+import shutil
+import smtplib
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+from pathlib import Path
 from textwrap import dedent
 
 # 1. Configuration
@@ -10,37 +15,81 @@ API_KEY = os.environ.get("GEMINI_API_KEY")
 if not API_KEY:
     raise ValueError("GEMINI_API_KEY environment variable not found.")
 
-genai.configure(api_key=API_KEY)
-
 # Use the model that supports Google Search tool
 MODEL_NAME = 'gemini-1.5-pro'
 
-def get_current_time_str():
-    """Returns current time in Taipei timezone."""
-    tz = pytz.timezone('Asia/Taipei')
-    now = datetime.datetime.now(tz)
+# On-disk LRU cache of rendered Markdown, keyed by a hash of the input
+_MD_CACHE_DIR = Path(".cache/md")
+_MD_CACHE_MAX_ENTRIES = 32
+
+# Markdown renderer options (mistune).
+# table plugin ~ 'tables', hard_wrap ~ 'nl2br'; fenced code is built in.
+# escape=False keeps raw HTML passing through, as python-markdown did.
+_MD_OPTIONS = {
+    'escape': False,
+    'hard_wrap': True,
+    'plugins': ['table', 'strikethrough'],
+}
+
+# "#Title" headings without a space, which python-markdown accepted but
+# CommonMark renders as text; fenced code blocks are matched first and
+# left untouched
+_ATX_NO_SPACE_RE = re.compile(
+    r'(?P<fence>^ {0,3}(?P<mark>`{3,}|~{3,}).*?^ {0,3}(?P=mark)[ \t]*$)'
+    r'|^(?P<hashes>#{1,6})(?=[^#\s])',
+    re.M | re.S,
+)
+
+# {{NAME}} placeholders in report.md, filled in a single pass
+_PROMPT_VARS_RE = re.compile(r'\{\{(\w+)\}\}')
+
+# Heavy third-party modules are imported on first use, so early exits
+# (e.g. a missing report.md) never pay their import cost.
+
+@functools.lru_cache(maxsize=1)
+def _get_genai():
+    """Imports and configures the Gemini SDK once."""
+    import google.generativeai as genai
+    genai.configure(api_key=API_KEY)
+    return genai
+
+@functools.lru_cache(maxsize=1)
+def _get_tz():
+    """Report timezone, resolved once."""
+    import pytz
+    return pytz.timezone('Asia/Taipei')
+
+@functools.lru_cache(maxsize=1)
+def _get_md():
+    """Markdown renderer, built once so plugins are not re-registered on every call."""
+    import mistune
+    return mistune.create_markdown(**_MD_OPTIONS)
+
+@functools.lru_cache(maxsize=1)
+def _get_md_cache_salt():
+    """Renderer version and options, hashed into cache keys so stale HTML is not reused."""
+    import mistune
+    return f"mistune {mistune.__version__} {_MD_OPTIONS!r}\n".encode("utf-8")
+
+def get_current_time_str(now):
+    """Formats a Taipei-timezone datetime for the prompt and page footer."""
     return now.strftime('%Y-%m-%d %H:%M:%S (UTC+8)')
 
 def read_report_prompt(filepath="report.md"):
     """Reads the prompt from the markdown file."""
-    with open(filepath, "r", encoding="utf-8") as f:
-        return f.read()
+    return Path(filepath).read_text(encoding="utf-8")
 
-def generate_report(prompt):
-    """Generates the report using Gemini API."""
-    # Debugging: Print version and available types
-    print(f"GenAI Version: {genai.__version__}")
-    
-    tools = []
+def _build_tools():
+    """Resolves the Google Search tool class for the installed SDK version."""
     from google.generativeai import protos
     
     # Try to find the correct Google Search tool class
     if hasattr(protos, 'GoogleSearch'):
         print("Found protos.GoogleSearch - Configuring tool...")
-        tools = [protos.Tool(google_search=protos.GoogleSearch())]
-    elif hasattr(protos, 'GoogleSearchRetrieval'):
+        return [protos.Tool(google_search=protos.GoogleSearch())]
+    if hasattr(protos, 'GoogleSearchRetrieval'):
         print("Found protos.GoogleSearchRetrieval - Configuring tool...")
-        tools = [
+        return [
             protos.Tool(
                 google_search_retrieval=protos.GoogleSearchRetrieval(
                     dynamic_retrieval_config=protos.DynamicRetrievalConfig(
@@ -50,16 +99,31 @@ def generate_report(prompt):
                 )
             )
         ]
-    else:
-        print("CRITICAL ERROR: Could not find GoogleSearch or GoogleSearchRetrieval in protos.")
-        print(f"Available protos: {[p for p in dir(protos) if 'Search' in p]}")
-        raise ImportError("Google Search tool class not found in installed google-generativeai version.")
+    print("CRITICAL ERROR: Could not find GoogleSearch or GoogleSearchRetrieval in protos.")
+    print(f"Available protos: {[p for p in dir(protos) if 'Search' in p]}")
+    raise ImportError("Google Search tool class not found in installed google-generativeai version.")
 
+@functools.lru_cache(maxsize=1)
+def _get_model():
+    """Builds the search-enabled model once and reuses it for every call."""
+    genai = _get_genai()
+    # Debugging: Print version and available types
+    print(f"GenAI Version: {genai.__version__}")
+    tools = _build_tools()
     print(f"Tools configuration: {tools}")
-    model = genai.GenerativeModel(MODEL_NAME, tools=tools)
+    return genai.GenerativeModel(MODEL_NAME, tools=tools)
+
+def generate_report(prompt, current_time_str):
+    """Generates the report using Gemini API."""
+    genai = _get_genai()
+    model = _get_model()
+    
+    # All report sections come from report.md as one prompt, so the whole
+    # report is a single API call; keep new sections in that prompt rather
+    # than issuing extra calls per section.
     
     # Add current time context to the prompt
-    full_prompt = f"{prompt}\n\n(System Note: The current execution time is {get_current_time_str()})"
+    full_prompt = f"{prompt}\n\n(System Note: The current execution time is {current_time_str})"
     
     # Configure generation to disable function calling to prevent "finish_reason: 10"
     generation_config = genai.types.GenerationConfig(
@@ -68,16 +132,24 @@ def generate_report(prompt):
     )
     
     try:
-        # Explicitly requesting text response
-        response = model.generate_content(full_prompt)
+        # Explicitly requesting text response, streamed so we start
+        # receiving tokens instead of blocking on the whole report
+        response = model.generate_content(full_prompt, stream=True)
+        chunks = []
+        for chunk in response:
+            # .parts raises ValueError on chunks with no candidates (e.g. ones
+            # carrying only usage metadata or prompt feedback), so check first
+            if chunk.candidates and chunk.parts:
+                chunks.append(chunk.text)
+        response.resolve()
         
         # Check if the response has a valid part
-        if not response.parts:
+        if not chunks:
              if response.prompt_feedback:
                  return f"Error: Blocked by safety filters. Feedback: {response.prompt_feedback}"
              return f"Error: Empty response. Finish reason: {response.candidates[0].finish_reason if response.candidates else 'Unknown'}"
 
-        return response.text
+        return "".join(chunks)
     except Exception as e:
         print(f"Error generating content with model {MODEL_NAME}: {e}")
         print("Attempting to list available models...")
@@ -90,43 +162,90 @@ def generate_report(prompt):
             
         return f"Error generating report: {e}. Check the Action logs for available models."
 
-def convert_to_html(markdown_text):
-    """Converts Markdown to HTML with extensions."""
-    html_content = markdown.markdown(
-        markdown_text,
-        extensions=['tables', 'fenced_code', 'nl2br']
+def _fix_atx_headings(markdown_text):
+    """Adds the missing space in "#Title" style headings outside code blocks."""
+    return _ATX_NO_SPACE_RE.sub(
+        lambda m: m.group('fence') or m.group('hashes') + ' ', markdown_text
     )
+
+def convert_to_html(markdown_text):
+    """Converts Markdown to HTML with extensions, reusing cached output for identical input."""
+    markdown_text = _fix_atx_headings(markdown_text)
+    key = hashlib.blake2b(
+        _get_md_cache_salt() + markdown_text.encode("utf-8"), digest_size=16
+    ).hexdigest()
+    cache_file = _MD_CACHE_DIR / f"{key}.html"
+    try:
+        html_content = cache_file.read_text(encoding="utf-8")
+    except FileNotFoundError:
+        pass
+    else:
+        # Touch the entry so eviction below is least-recently-used
+        try:
+            os.utime(cache_file)
+        except OSError:
+            pass
+        return html_content
+    
+    html_content = _get_md()(markdown_text)
+    
+    try:
+        _MD_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        # Atomic write, so an interrupted run never leaves a truncated entry
+        _replace_file(cache_file, html_content.encode("utf-8"))
+        # Keep only the most recently used entries
+        entries = sorted(_MD_CACHE_DIR.glob("*.html"), key=lambda p: p.stat().st_mtime_ns)
+        for stale in entries[:-_MD_CACHE_MAX_ENTRIES]:
+            stale.unlink(missing_ok=True)
+    except OSError as e:
+        print(f"Warning: could not update Markdown cache: {e}")
     return html_content
 
+_HISTORY_HEAD = (
+    '\n'
+    '        <div class="history-section">\n'
+    '            <h3>📅 歷史報告存檔</h3>\n'
+    '            <ul>\n'
+    '                '
+)
+
+_HISTORY_TAIL = (
+    '\n'
+    '            </ul>\n'
+    '        </div>\n'
+)
+
 def get_history_links():
     """Scans the reports directory and returns a list of links."""
-    if not os.path.exists("reports"):
+    try:
+        with os.scandir("reports") as entries:
+            filenames = sorted(
+                (entry.name for entry in entries if entry.name.endswith(".html")),
+                reverse=True,
+            )
+    except FileNotFoundError:
         return ""
     
-    links = []
-    for filename in sorted(os.listdir("reports"), reverse=True):
-        if filename.endswith(".html"):
-            date_str = filename.replace(".html", "")
-            links.append(f'<li><a href="reports/{filename}">{date_str}</a></li>')
-    
-    if not links:
+    if not filenames:
         return ""
-        
-    return f"""
-    <div class="history-section">
-        <h3>📅 歷史報告存檔</h3>
-        <ul>
-            {''.join(links)}
-        </ul>
-    </div>
-    """
-
-def create_html_page(report_html):
-    """Wraps the report content in a responsive HTML template."""
-    current_time = get_current_time_str()
-    history_links = get_history_links()
     
-    css = """
+    # Build the whole section in one join rather than joining the links
+    # and then copying them again into a wrapper string
+    parts = [_HISTORY_HEAD]
+    for filename in filenames:
+        parts.append(f'<li><a href="reports/{filename}">{filename[:-5]}</a></li>')
+    parts.append(_HISTORY_TAIL)
+    return "".join(parts)
+
+def _minify_css(css):
+    """Strips comments and redundant whitespace from a stylesheet."""
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};:,])\s*', r'\1', css)
+    return css.strip()
+
+# Page template pieces, assembled once at import time
+_CSS = _minify_css(dedent("""
     :root {
         --primary-color: #2c3e50;
         --accent-color: #3498db;
@@ -266,89 +385,128 @@ def create_html_page(report_html):
             font-size: 0.9rem;
         }
     }
-    """
-    
-    html_template = f"""
-    <!DOCTYPE html>
-    <html lang="zh-TW">
-    <head>
-        <meta charset="UTF-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <title>每日美股宏觀晨報</title>
-        <style>
-            {dedent(css)}
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            {report_html}
-            
-            {history_links}
-            
-            <div class="footer">
-                <p>Generated automatically by AI Agent at {current_time}</p>
-            </div>
-        </div>
-    </body>
-    </html>
-    """
-    return html_template
+    """))
+
+_HTML_HEAD = (
+    '<!DOCTYPE html>\n'
+    '<html lang="zh-TW">\n'
+    '<head>\n'
+    '    <meta charset="UTF-8">\n'
+    '    <meta name="viewport" content="width=device-width, initial-scale=1.0">\n'
+    '    <title>每日美股宏觀晨報</title>\n'
+    '    <style>' + _CSS + '</style>\n'
+    '</head>\n'
+    '<body>\n'
+    '    <div class="container">\n'
+)
+
+_HTML_FOOTER_START = (
+    '\n'
+    '        <div class="footer">\n'
+    '            <p>Generated automatically by AI Agent at '
+)
+
+_HTML_TAIL = (
+    '</p>\n'
+    '        </div>\n'
+    '    </div>\n'
+    '</body>\n'
+    '</html>\n'
+)
+
+def create_html_page(report_html, current_time):
+    """Wraps the report content in a responsive HTML template."""
+    history_links = get_history_links()
+    return "".join((
+        _HTML_HEAD, report_html, "\n", history_links,
+        _HTML_FOOTER_START, current_time, _HTML_TAIL,
+    ))
 
 def main():
     print("Starting report generation...")
     
     # 1. Read Prompt
-    if not os.path.exists("report.md"):
+    try:
+        prompt = read_report_prompt()
+    except FileNotFoundError:
         print("Error: report.md not found!")
         return
     
-    prompt = read_report_prompt()
-    
-    # Inject current system time into the prompt placeholder
-    current_time_str = get_current_time_str()
-    prompt = prompt.replace("{{CURRENT_DATE}}", current_time_str)
+    # Take a single timestamp for the prompt, page footer and archive filename
+    now = datetime.datetime.now(_get_tz())
+    current_time_str = get_current_time_str(now)
+    today_str = now.strftime('%Y-%m-%d')
+
+    # Inject current system time into the prompt placeholders;
+    # unknown placeholders are left as-is
+    prompt_vars = {
+        'CURRENT_DATE': current_time_str,
+        'WEEKDAY': now.strftime('%A'),
+    }
+    prompt = _PROMPT_VARS_RE.sub(
+        lambda m: prompt_vars.get(m.group(1), m.group(0)), prompt
+    )
     
     print(f"Prompt loaded and time injected: {current_time_str}")
     
     # 2. Generate Content
     print("Querying Gemini API...")
-    report_markdown = generate_report(prompt)
+    report_markdown = generate_report(prompt, current_time_str)
     print("Report generated.")
     
     # 3. Convert to HTML
     report_html = convert_to_html(report_markdown)
     
     # 4. Create Full Page
-    full_html = create_html_page(report_html)
+    full_html = create_html_page(report_html, current_time_str)
+    
+    # 5. Save and archive the report
+    save_report(full_html, today_str)
     
-    # 5. Save to index.html (Current Report)
-    with open("index.html", "w", encoding="utf-8") as f:
-        f.write(full_html)
+    # 6. Send Email only once the report is published
+    send_email(full_html, today_str)
+
+def _replace_file(path, data):
+    """Writes data to a temp file and swaps it in over path.
+    
+    Always creates a new inode, since the previous file may be hard-linked
+    to an older archive that must stay untouched.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def _link_or_copy(src, dst):
+    """Hard-links dst to src, copying where links are unsupported."""
+    try:
+        os.remove(dst)
+    except FileNotFoundError:
+        pass
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+def save_report(full_html, today_str):
+    """Writes index.html and the dated archive copy."""
+    # Save to index.html (Current Report)
+    # Encode once; the archive below reuses the written file.
+    payload = full_html.encode("utf-8")
+    _replace_file("index.html", payload)
     print("Success! index.html has been created.")
     
-    # 6. Archive Report
+    # Archive Report
     # Create reports directory if not exists
-    if not os.path.exists("reports"):
-        os.makedirs("reports")
+    os.makedirs("reports", exist_ok=True)
         
-    # Get today's date for filename (e.g., 2025-11-23.html)
-    tz = pytz.timezone('Asia/Taipei')
-    today_str = datetime.datetime.now(tz).strftime('%Y-%m-%d')
+    # Use today's date for filename (e.g., 2025-11-23.html)
     archive_filename = f"reports/{today_str}.html"
-    
-    with open(archive_filename, "w", encoding="utf-8") as f:
-        f.write(full_html)
+    _link_or_copy("index.html", archive_filename)
     print(f"Archived to {archive_filename}")
-    
-    # 7. Send Email
-    send_email(full_html, today_str)
 
 def send_email(html_content, date_str):
     """Sends the report via email."""
-    import smtplib
-    from email.mime.text import MIMEText
-    from email.mime.multipart import MIMEMultipart
-    
     sender_email = os.environ.get("EMAIL_SENDER")
     sender_password = os.environ.get("EMAIL_PASSWORD")
     
@@ -368,11 +526,15 @@ def send_email(html_content, date_str):
         msg['Subject'] = f"📊 每日美股宏觀晨報 ({date_str})"
         
         msg.attach(MIMEText(html_content, 'html'))
+        # Serialize once; the same bytes are reused for every send.
+        # sendmail() sends bytes unchanged, so SMTP's CRLF line endings
+        # must be applied here (send_message() used to do this)
+        payload = msg.as_bytes(policy=msg.policy.clone(linesep="\r\n"))
         
-        # Connect to Gmail SMTP server
+        # Connect to Gmail SMTP server (one TLS session for all sends)
         with smtplib.SMTP_SSL('smtp.gmail.com', 465) as server:
             server.login(sender_email, sender_password)
-            server.send_message(msg)
+            server.sendmail(sender_email, recipients, payload)
             
         print("Email sent successfully!")
     except Exception as e: